@@ -1,80 +1,183 @@
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from numba import njit
 import pickle
+import os
+import tempfile
+import functools
+from types import SimpleNamespace
 
 '''
 Build dictionaries for internal reference IDs and KEGG IDs.
-Returns:
-    stoich_matrix: 2D stoichiometric matrix array
+Call load() to get them; the data is built once per process and cached.
+Returns a namespace with:
+    stoich_matrix: sparse (CSR) stoichiometric matrix, reactions x metabolites
 
     met_map: KEGG metabolite ID to internal index
-    inv_met_map: internal index to KEGG metabolite ID
+    inv_met_map: list of KEGG metabolite IDs, indexed by internal index
     rxn_map: KEGG reaction ID to internal index
-    inv_rxn_map: internal index to KEGG reaction ID
+    inv_rxn_map: list of KEGG reaction IDs, indexed by internal index
     cpd_string_dict: KEGG metabolite IDs to chemical compound names
     display_lookup: KEGG reaction IDs to reaction strings
 
     mets: list of internal indices for all metabolites
     rxns: list of internal indices for all reactions
-    Currency: list of internal indices for currency metabolites
-    Energy: list of internal indices for nutrient metabolites
-    Core: list of internal indices for core metabolites
-
-    rho: reactant stoichiometric matrix (negative entries, others set to 0)
-    pi: product stoichiometric matrix (positive entries, others set to 0)
-    rxnMat: binary reactant matrix (1 if metabolite is a reactant, else 0)
-    prodMat: binary product matrix (1 if metabolite is a product, else 0)
+    Currency: array of internal indices for currency metabolites
+    Energy: array of internal indices for nutrient metabolites
+    Core: array of internal indices for core metabolites
+
+    rho: sparse reactant stoichiometric matrix (negative entries, others set to 0)
+    pi: sparse product stoichiometric matrix (positive entries, others set to 0)
+    rxnMat: sparse binary reactant matrix (1 if metabolite is a reactant, else 0)
+    prodMat: sparse binary product matrix (1 if metabolite is a product, else 0)
     sumRxnVec: vector of counts of reactants per reaction
     sumProdVec: vector of counts of products per reaction
 '''
 
-# Load stoichiometric matrix
-stoich_matrix_df = pd.read_csv("map01100_stoich_matrix.csv", index_col=0).T
-stoich_matrix = stoich_matrix_df.values
-
-metabolites = stoich_matrix_df.columns.tolist()
-reactions = stoich_matrix_df.index.tolist()
-
-# Metabolite dictionaries
-met_map = kegg_to_id = {met_id: idx for idx, met_id in enumerate(metabolites)}
-inv_met_map = id_to_kegg = {idx: met_id for met_id, idx in met_map.items()}
-with open(f"met_map.pkl", "wb") as f:
-    pickle.dump(met_map, f)
-with open(f"inv_met_map.pkl", "wb") as f:
-    pickle.dump(inv_met_map, f)
-
-# Reactions dictionaries
-rxn_map = rxn_kegg_to_id = {rxn_id: idx for idx, rxn_id in enumerate(reactions)}
-inv_rxn_map = rxn_id_to_kegg = {idx: rxn_id for rxn_id, idx in rxn_map.items()}
-with open(f"rxn_map.pkl", "wb") as f:
-    pickle.dump(rxn_map, f)
-with open(f"inv_rxn_map.pkl", "wb") as f:
-    pickle.dump(inv_rxn_map, f)
-
-# Currency and nutrient metabolites
-currency_mets_idx = pd.read_csv("kegg_currency.txt", header=None)[0].tolist()
-energy_mets_idx = pd.read_csv("kegg_nutrients.txt", header=None)[0].tolist()
-core_mets_idx = pd.read_csv("kegg_core.txt", header=None)[0].tolist()
-
-Currency = [met_map[i] for i in currency_mets_idx if i in met_map]
-Energy = [met_map[i] for i in energy_mets_idx if i in met_map]
-Core = [met_map[i] for i in core_mets_idx if i in met_map]
-
-# Compound names dictionary
-mets = list(met_map.values())
-rxns = list(rxn_map.values())
-with open("cpd_string_dict.pkl", "rb") as f:
-    cpd_string_dict = pickle.load(f)
-with open("rxn_string_dict.pkl", "rb") as f:
-    display_lookup = pickle.load(f)
-
-# Defining reactant, product and reactant vectors/matrices for the scope expansion algorithm.
-rho = stoich_matrix.clip(max = 0.0)
-pi = stoich_matrix.clip(min = 0.0)
-rxnMat = (rho != 0) * 1
-prodMat = (pi != 0) * 1
-sumRxnVec = np.sum(rxnMat, axis = 1)
-sumProdVec = np.sum(prodMat, axis = 1)
+@njit(cache=True)
+def build_matrices(indptr, indices, data):
+    """
+    Splits a CSR stoichiometric matrix into reactant and product parts
+    in a single pass over its non-zero entries.
+    Returns the CSR arrays (indptr, indices, data) of rho and pi, and the
+    reactant and product counts per reaction.
+    """
+    n_rows, nnz = len(indptr) - 1, len(data)
+    rho_indptr, pi_indptr = np.zeros(n_rows + 1, np.int32), np.zeros(n_rows + 1, np.int32)
+    rho_indices, pi_indices = np.empty(nnz, np.int32), np.empty(nnz, np.int32)
+    rho_data, pi_data = np.empty(nnz, data.dtype), np.empty(nnz, data.dtype)
+    sumRxnVec, sumProdVec = np.zeros(n_rows, np.int32), np.zeros(n_rows, np.int32)
+
+    n_rho, n_pi = 0, 0
+    for i in range(n_rows):
+        for k in range(indptr[i], indptr[i + 1]):
+            v = data[k]
+            if v < 0:
+                rho_indices[n_rho] = indices[k]
+                rho_data[n_rho] = v
+                n_rho += 1
+                sumRxnVec[i] += 1
+            elif v > 0:
+                pi_indices[n_pi] = indices[k]
+                pi_data[n_pi] = v
+                n_pi += 1
+                sumProdVec[i] += 1
+        rho_indptr[i + 1] = n_rho
+        pi_indptr[i + 1] = n_pi
+
+    return (rho_indptr, rho_indices[:n_rho], rho_data[:n_rho],
+            pi_indptr, pi_indices[:n_pi], pi_data[:n_pi], sumRxnVec, sumProdVec)
+
+def load_cached(parquet_path="map01100_stoich_matrix.parquet"):
+    """
+    Loads a stoichiometric matrix parquet file (one row per non-zero
+    coefficient, as written by scrape_data.save_parquet) as a sparse (CSR)
+    matrix of reactions x metabolites, along with the reaction and metabolite IDs.
+    The parsed matrix is saved next to the parquet file as .npy files, which are
+    memory-mapped instead of re-reading the parquet file while they are newer than it.
+    Each file is written to a temporary file and renamed into place, and the
+    indptr file is written last, so the cache counts as fresh only once the
+    whole set is complete and other processes never map a partial file.
+    """
+    stem = os.path.splitext(parquet_path)[0]
+    paths = {name: f"{stem}_{name}.npy"
+             for name in ("data", "indices", "reactions", "metabolites", "indptr")}
+    parquet_mtime = os.path.getmtime(parquet_path)
+
+    if (all(os.path.exists(path) for path in paths.values())
+            and os.path.getmtime(paths["indptr"]) >= parquet_mtime):
+        arrays = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+    else:
+        entries = pd.read_parquet(parquet_path)
+        rxn_ids, met_ids = entries["reaction"].cat, entries["metabolite"].cat
+        csr = sparse.csr_matrix(
+            (entries["coefficient"].to_numpy(np.int8),
+             (rxn_ids.codes.to_numpy(np.int32), met_ids.codes.to_numpy(np.int32))),
+            shape = (len(rxn_ids.categories), len(met_ids.categories)))
+        arrays = {"data": csr.data, "indices": csr.indices, "indptr": csr.indptr,
+                  "reactions": rxn_ids.categories.to_numpy(dtype=str),
+                  "metabolites": met_ids.categories.to_numpy(dtype=str)}
+        for name, path in paths.items():
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                            prefix=os.path.basename(path) + ".", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, arrays[name])
+            os.replace(tmp_path, path)
+
+    reactions = arrays["reactions"].tolist()
+    metabolites = arrays["metabolites"].tolist()
+    stoich_matrix = sparse.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape = (len(reactions), len(metabolites)))
+    return stoich_matrix, reactions, metabolites
+
+def _build():
+    """
+    Loads the stoichiometric matrix and builds all of the objects listed above.
+    The ID map pickles are only written if they do not exist yet.
+    """
+    # Load stoichiometric matrix
+    stoich_matrix, reactions, metabolites = load_cached("map01100_stoich_matrix.parquet")
+
+    # Metabolite dictionaries
+    met_map = {met_id: idx for idx, met_id in enumerate(metabolites)}
+    inv_met_map = metabolites
+    for path, obj in [("met_map.pkl", met_map), ("inv_met_map.pkl", inv_met_map)]:
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                pickle.dump(obj, f)
+
+    # Reactions dictionaries
+    rxn_map = {rxn_id: idx for idx, rxn_id in enumerate(reactions)}
+    inv_rxn_map = reactions
+    for path, obj in [("rxn_map.pkl", rxn_map), ("inv_rxn_map.pkl", inv_rxn_map)]:
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                pickle.dump(obj, f)
+
+    # Currency and nutrient metabolites
+    currency_mets_idx = np.loadtxt("kegg_currency.txt", dtype=str, ndmin=1)
+    energy_mets_idx = np.loadtxt("kegg_nutrients.txt", dtype=str, ndmin=1)
+    core_mets_idx = np.loadtxt("kegg_core.txt", dtype=str, ndmin=1)
+
+    Currency = np.fromiter((met_map[i] for i in currency_mets_idx if i in met_map), dtype=np.int32)
+    Energy = np.fromiter((met_map[i] for i in energy_mets_idx if i in met_map), dtype=np.int32)
+    Core = np.fromiter((met_map[i] for i in core_mets_idx if i in met_map), dtype=np.int32)
+
+    # Compound names dictionary
+    mets = list(met_map.values())
+    rxns = list(rxn_map.values())
+    with open("cpd_string_dict.pkl", "rb") as f:
+        cpd_string_dict = pickle.load(f)
+    with open("rxn_string_dict.pkl", "rb") as f:
+        display_lookup = pickle.load(f)
+
+    # Defining reactant, product and reactant vectors/matrices for the scope expansion algorithm.
+    # Only the non-zero entries are stored, so products with vectors (rxnMat @ x)
+    # cost O(nnz) rather than O(reactions x metabolites).
+    (rho_indptr, rho_indices, rho_data, pi_indptr, pi_indices, pi_data,
+     sumRxnVec, sumProdVec) = build_matrices(
+        stoich_matrix.indptr, stoich_matrix.indices, stoich_matrix.data)
+    rho = sparse.csr_matrix((rho_data, rho_indices, rho_indptr), shape = stoich_matrix.shape)
+    pi = sparse.csr_matrix((pi_data, pi_indices, pi_indptr), shape = stoich_matrix.shape)
+    # The binary matrices share rho's and pi's indptr and indices; their data is
+    # the boolean non-zero mask reinterpreted as int8, without a copy.
+    rxnMat = sparse.csr_matrix(((rho_data != 0).view(np.int8), rho_indices, rho_indptr),
+                               shape = stoich_matrix.shape)
+    prodMat = sparse.csr_matrix(((pi_data != 0).view(np.int8), pi_indices, pi_indptr),
+                                shape = stoich_matrix.shape)
+
+    return SimpleNamespace(
+        stoich_matrix=stoich_matrix, reactions=reactions, metabolites=metabolites,
+        met_map=met_map, inv_met_map=inv_met_map, rxn_map=rxn_map, inv_rxn_map=inv_rxn_map,
+        cpd_string_dict=cpd_string_dict, display_lookup=display_lookup,
+        mets=mets, rxns=rxns, Currency=Currency, Energy=Energy, Core=Core,
+        rho=rho, pi=pi, rxnMat=rxnMat, prodMat=prodMat,
+        sumRxnVec=sumRxnVec, sumProdVec=sumProdVec,
+    )
+
+load = functools.lru_cache(maxsize=1)(_build)
 
 # #-------------------------------------------------------------------------
 # # Check for non-reversible reactions
@@ -27,7 +27,7 @@ def giveRevScope(rxnMat, prodMat, sumRxnVec, nutrientSet, Currency, coreTBP):
     """
 
     # Initializing all the vectors to propagate the satisfied subgraph search.
-    seedVec, rxnProc = np.zeros(len(np.transpose(rxnMat))), np.zeros(len(rxnMat))
+    seedVec, rxnProc = np.zeros(rxnMat.shape[1]), np.zeros(rxnMat.shape[0])
     seedVec[coreTBP] = 1
     currScopeMets = np.copy(seedVec)
     prevScopeMets = np.copy(seedVec)
@@ -37,8 +37,8 @@ def giveRevScope(rxnMat, prodMat, sumRxnVec, nutrientSet, Currency, coreTBP):
         prevScopeMets = np.logical_or(currScopeMets, prevScopeMets)
 
         # Propagating reverse scope.
-        rxnProc = (np.dot(prodMat, deltaMetVec) + rxnProc > 0) * 1
-        currScopeMets = (np.dot(np.transpose(rxnMat), np.dot(prodMat, deltaMetVec)) > 0) * 1
+        rxnProc = (prodMat @ deltaMetVec + rxnProc > 0) * 1
+        currScopeMets = (rxnMat.T @ (prodMat @ deltaMetVec) > 0) * 1
         currScopeMets = np.logical_xor(currScopeMets, np.logical_and(currScopeMets, prevScopeMets))
 
         # Marking the satisfied metabolites and reactions.
@@ -12,17 +12,18 @@ def markSatMetsRxns(rxnProc, rxnMat, prodMat, sumRxnVec, nutrientSet, Currency):
         satMetVec, satRxnVec: the current sets of metabolites and reactions
                           that are said to be satisfied.
     """
-    satMetVec = np.zeros(len(np.transpose(rxnMat)))
-    satMetVec[nutrientSet + Currency] = 1
-    satRxnVec = np.zeros(len(rxnMat))
+    satMetVec = np.zeros(rxnMat.shape[1])
+    satMetVec[nutrientSet] = 1
+    satMetVec[Currency] = 1
+    satRxnVec = np.zeros(rxnMat.shape[0])
 
     while True:
         oldSatRxnVec = np.copy(satRxnVec)
 
         # Marking first reactions, then metabolites, iteratively.
-        satRxnVec = np.logical_and((np.dot(rxnMat, satMetVec) - sumRxnVec == 0) * 1, 
+        satRxnVec = np.logical_and((rxnMat @ satMetVec - sumRxnVec == 0) * 1, 
                                    rxnProc) * 1
-        satMetVec = (np.dot(np.transpose(prodMat), satRxnVec) + satMetVec > 0) * 1
+        satMetVec = (prodMat.T @ satRxnVec + satMetVec > 0) * 1
 
         # Checking if all satisfied nodes have been marked.
         if np.array_equal(oldSatRxnVec, satRxnVec):
@@ -1,8 +1,160 @@
-from Bio.KEGG import REST
-import pandas as pd
+import aiohttp
+from aiolimiter import AsyncLimiter
+import asyncio
+import sqlite3
 import time
-from tqdm import tqdm
+from contextlib import closing
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from tqdm.asyncio import tqdm
 import pickle
+import re
+from collections import Counter
+
+KEGG_URL = "https://rest.kegg.jp"
+MAX_REQUESTS = 3  # KEGG allows at most 3 requests per second
+BATCH_SIZE = 10   # KEGG returns at most 10 entries per get request
+RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_FACTOR = 0.5  # retries wait 0.5s, 1s, 2s, ...
+CACHE_PATH = "kegg_cache.sqlite"  # parsed records, stored per KEGG ID
+CACHE_EXPIRY = timedelta(days=30)
+USER_AGENT = "costly_cross_feeding/0.1"
+
+# One "[coefficient] metabolite" term of a KEGG equation, e.g. "2 C00001" or
+# "C00721(n)". Terms must be whole whitespace-separated tokens, so entries
+# such as "C01330(side 1)" are skipped as before.
+TERM_RE = re.compile(r"(?<!\S)(?:(\d+)\s+)?([CG]\d{5}(?:\([^)\s]*\))?)(?!\S)")
+
+# A KEGG compound, glycan or reaction entry ID, e.g. "C00001"
+KEGG_ID_RE = re.compile(r"[CGR]\d{5}")
+
+# Fields of a KEGG flat-file record; NAME captures the first (primary) name
+NAME_RE = re.compile(r"^NAME\s+(.+?)(?:;|$)", re.M)
+EQUATION_RE = re.compile(r"^EQUATION\s+(.+)$", re.M)
+
+def kegg_session():
+    """
+    Open an HTTP session for KEGG requests.
+    Requests share a pool of at most MAX_REQUESTS keep-alive connections,
+    so the TCP/TLS handshake is paid once per connection, not per request.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=MAX_REQUESTS),
+        headers={"User-Agent": USER_AGENT},
+        timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=30),
+    )
+
+def open_cache():
+    """
+    Open the on-disk record cache, creating its table if needed.
+    """
+    db = sqlite3.connect(CACHE_PATH)
+    db.execute("CREATE TABLE IF NOT EXISTS records "
+               "(kegg_id TEXT PRIMARY KEY, record TEXT, fetched REAL)")
+    return db
+
+def read_cache(kegg_ids):
+    """
+    Returns a dictionary of cached records for those of kegg_ids that were
+    fetched within CACHE_EXPIRY.
+    """
+    wanted = set(kegg_ids)
+    cutoff = time.time() - CACHE_EXPIRY.total_seconds()
+    with closing(open_cache()) as db:
+        rows = db.execute("SELECT kegg_id, record FROM records WHERE fetched >= ?", (cutoff,))
+        return {kegg_id: record for kegg_id, record in rows if kegg_id in wanted}
+
+def write_cache(records):
+    """
+    Stores fetched records in the cache, keyed by KEGG ID.
+    Records that failed to fetch (None) are not stored.
+    """
+    fetched = time.time()
+    with closing(open_cache()) as db, db:
+        db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                       [(kegg_id, record, fetched)
+                        for kegg_id, record in records.items() if record is not None])
+
+#-------------------------------------------------------------------------
+# 0. Fetch KEGG records concurrently
+#-------------------------------------------------------------------------
+async def fetch(session, limiter, kegg_ids):
+    """
+    Fetch the flat-file records for up to BATCH_SIZE KEGG IDs in one request.
+    Every request waits for the shared rate limiter. Connection errors,
+    timeouts and RETRY_STATUSES responses are retried up to RETRIES times
+    with exponential backoff, or after the server's Retry-After delay if it
+    gives one.
+    Returns a dictionary of KEGG ID to record, with None for IDs that
+    could not be fetched.
+    """
+    records = dict.fromkeys(kegg_ids)
+    url = f"{KEGG_URL}/get/{'+'.join(kegg_ids)}"
+    response, error = None, None
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(wait)
+        wait = None  # set when the request should be retried
+        async with limiter:
+            try:
+                async with session.get(url) as r:
+                    if r.status in RETRY_STATUSES:
+                        retry_after = r.headers.get("Retry-After", "")
+                        wait = int(retry_after) if retry_after.isdigit() else BACKOFF_FACTOR * 2 ** attempt
+                    r.raise_for_status()
+                    response = await r.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error, wait = e, BACKOFF_FACTOR * 2 ** attempt
+            except Exception as e:
+                error = e
+        if wait is None:
+            break
+
+    if response is None:
+        print(f"Failed to fetch {', '.join(kegg_ids)}: {error}")
+        response = ""
+
+    # Entries are separated by "///" and identified by their ENTRY line
+    for entry in response.split("///"):
+        entry = entry.strip()
+        if entry.startswith("ENTRY"):
+            kegg_id = entry.split()[1]
+            if kegg_id in records:
+                records[kegg_id] = entry
+    return records
+
+def fetch_records(kegg_ids, desc):
+    """
+    Fetch the records for a list of KEGG IDs in batches of BATCH_SIZE,
+    starting at most MAX_REQUESTS requests per second.
+    Records are cached on disk per KEGG ID, so only IDs not fetched within
+    CACHE_EXPIRY are requested, however the IDs are grouped into batches.
+    IDs that are not KEGG entry IDs, such as "C00464(n+1)", are not queried:
+    joined with '+' they would break the rest of their batch.
+    Returns a dictionary mapping each KEGG ID to its record (None if failed).
+    """
+    records = dict.fromkeys(kegg_ids)
+    valid_ids = [kegg_id for kegg_id in kegg_ids if KEGG_ID_RE.fullmatch(kegg_id)]
+    records.update(read_cache(valid_ids))
+    missing = [kegg_id for kegg_id in valid_ids if records[kegg_id] is None]
+    chunks = [missing[i:i + BATCH_SIZE] for i in range(0, len(missing), BATCH_SIZE)]
+
+    async def main():
+        limiter = AsyncLimiter(MAX_REQUESTS, 1)
+        async with kegg_session() as session:
+            return await tqdm.gather(
+                *(fetch(session, limiter, chunk) for chunk in chunks),
+                desc=desc,
+            )
+
+    fetched = {}
+    for chunk_records in asyncio.run(main()):
+        fetched.update(chunk_records)
+    write_cache(fetched)
+    records.update(fetched)
+    return records
 
 #-------------------------------------------------------------------------
 # 1. Fetch reaction IDs from a KEGG pathway/module
@@ -12,27 +164,31 @@ def get_reactions(pathway_id="map01100"):
     Fetch all KEGG reaction IDs from a given pathway.
     Returns a list of reaction IDs.
     """
-    response = REST.kegg_link("reaction", f"path:{pathway_id}").read()
+    async def main():
+        async with kegg_session() as session:
+            async with session.get(f"{KEGG_URL}/link/reaction/path:{pathway_id}") as r:
+                r.raise_for_status()
+                return await r.text()
+
+    response = asyncio.run(main())
     lines = response.strip().split("\n")
     reaction_ids = [line.split("\t")[1].split(":")[1] for line in lines]
     return reaction_ids
 
 #-------------------------------------------------------------------------
-# 2. Fetch the equation for a given reaction
+# 2. Fetch the equations for a list of reactions
 #-------------------------------------------------------------------------
-def get_equations(rxn_id):
+def get_equations(rxn_ids):
     """
-    Fetch the equation line for a KEGG reaction ID.
-    Returns the equation string.
+    Fetch the equation lines for a list of KEGG reaction IDs.
+    Returns a dictionary of reaction ID to equation string (None if missing).
     """
-    try:
-        entry = REST.kegg_get(rxn_id).read()
-        for line in entry.split("\n"):
-            if line.startswith("EQUATION"):
-                return line.replace("EQUATION", "").strip()
-    except Exception as e:
-        print(f"Failed to fetch {rxn_id}: {e}")
-    return None
+    records = fetch_records(rxn_ids, "Processing reactions")
+    equations = {}
+    for rxn_id, record in records.items():
+        m = EQUATION_RE.search(record) if record else None
+        equations[rxn_id] = m.group(1).strip() if m else None
+    return equations
 
 #-------------------------------------------------------------------------
 # 3. Parse an equation into metabolites & coefficients
@@ -44,48 +200,32 @@ def parse_equation(equation):
     Reactants are negative, products are positive.
     Cancels out metabolites that appear on both sides.
     """
-    stoich = {}
-
     if "<=>" in equation:
-        lhs, rhs = equation.split(" <=> ")
+        lhs, rhs = equation.split("<=>", 1)
     elif "=>" in equation:
-        lhs, rhs = equation.split(" => ")
+        lhs, rhs = equation.split("=>", 1)
     else:
         return [], []
 
+    stoich = Counter()
     # Reactants (negative)
-    for term in lhs.split(" + "):
-        parts = term.strip().split()
-        if len(parts) == 0:
-            continue
-        coeff = int(parts[0]) if parts[0].isdigit() else 1
-        met = parts[-1]
-        if met.startswith(("C", "G")):
-            stoich[met] = stoich.get(met, 0) - coeff
+    for coeff, met in TERM_RE.findall(lhs):
+        stoich[met] -= int(coeff) if coeff else 1
 
     # Products (positive)
-    for term in rhs.split(" + "):
-        parts = term.strip().split()
-        if len(parts) == 0:
-            continue
-        coeff = int(parts[0]) if parts[0].isdigit() else 1
-        met = parts[-1]
-        if met.startswith(("C", "G")):
-            stoich[met] = stoich.get(met, 0) + coeff
+    for coeff, met in TERM_RE.findall(rhs):
+        stoich[met] += int(coeff) if coeff else 1
 
     # Drop any metabolites with net coefficient 0
-    mets, coeffs = [], []
-    for met, coeff in stoich.items():
-        if coeff != 0:
-            mets.append(met)
-            coeffs.append(coeff)
+    mets = [met for met, coeff in stoich.items() if coeff != 0]
+    coeffs = [stoich[met] for met in mets]
 
     return mets, coeffs
 
 #-------------------------------------------------------------------------
 # 4. Build stoichiometric matrix from reactions
 #-------------------------------------------------------------------------
-def build_stoich_matrix(reaction_ids, sleep_time=0.1):
+def build_stoich_matrix(reaction_ids):
     """
     Build a stoichiometric matrix (metabolites x reactions).
     Each reversible reaction is split into forward and reverse columns.
@@ -93,9 +233,10 @@ def build_stoich_matrix(reaction_ids, sleep_time=0.1):
     """
     reaction_stoich = {}
     all_metabolites = set()
-    
-    for rxn_id in tqdm(reaction_ids, desc="Processing reactions"):
-        eqn = get_equations(rxn_id)
+    equations = get_equations(reaction_ids)
+
+    for rxn_id in reaction_ids:
+        eqn = equations[rxn_id]
         if not eqn:
             continue
 
@@ -112,18 +253,35 @@ def build_stoich_matrix(reaction_ids, sleep_time=0.1):
             reaction_stoich[reverse_id] = {m: -c for m, c in zip(mets, coeffs)}
             all_metabolites.update(mets)
 
-        time.sleep(sleep_time)
+    # Build DataFrame from (row, column, value) triples in one assignment
+    met_index = pd.Index(sorted(all_metabolites))
+    mets, cols, vals = [], [], []
+    for j, stoich in enumerate(reaction_stoich.values()):
+        mets.extend(stoich.keys())
+        vals.extend(stoich.values())
+        cols.extend([j] * len(stoich))
 
-    # Build DataFrame
-    stoich_matrix = pd.DataFrame(
-        0, index=sorted(all_metabolites), columns=reaction_stoich.keys()
-    )
-    for rxn, stoich in reaction_stoich.items():
-        for met, coeff in stoich.items():
-            stoich_matrix.loc[met, rxn] = coeff
+    # Resolve all metabolite labels to row positions in one vectorised lookup
+    rows = met_index.get_indexer(mets)
+    arr = np.zeros((len(met_index), len(reaction_stoich)), dtype=np.int32)
+    arr[rows, cols] = vals
+    stoich_matrix = pd.DataFrame(arr, index=met_index, columns=list(reaction_stoich))
 
     return stoich_matrix
 
+def save_parquet(stoich_matrix, path):
+    """
+    Save a stoichiometric matrix (metabolites x reactions) to parquet,
+    with one row per non-zero coefficient. Metabolite and reaction IDs are
+    stored as categoricals, which keeps the full row and column order.
+    """
+    rows, cols = np.nonzero(stoich_matrix.values)
+    pd.DataFrame({
+        "metabolite": pd.Categorical.from_codes(rows, categories=stoich_matrix.index),
+        "reaction": pd.Categorical.from_codes(cols, categories=stoich_matrix.columns),
+        "coefficient": stoich_matrix.values[rows, cols].astype(np.int8),
+    }).to_parquet(path, index=False)
+
 #-------------------------------------------------------------------------
 # 5. Scrape data and generate matrix
 #-------------------------------------------------------------------------
@@ -139,66 +297,43 @@ def get_matrix(pathway_id):
     print("Stoichiometric matrix shape:", stoich_matrix.shape)
     print(stoich_matrix.head())
 
-    # Save to CSV
+    # Save to CSV, and to parquet for load_data
     stoich_matrix.to_csv(f"{pathway_id}_stoich_matrix.csv")
-    print(f"Matrix saved to {pathway_id}_stoich_matrix.csv")
+    save_parquet(stoich_matrix, f"{pathway_id}_stoich_matrix.parquet")
+    print(f"Matrix saved to {pathway_id}_stoich_matrix.csv and .parquet")
 
     return stoich_matrix
 
 #-------------------------------------------------------------------------
 # 6. Get compound and reaction strings from KEGG IDs
 #-------------------------------------------------------------------------
-def get_cpd_names(met_ids, sleep_time=0.1):
+def get_cpd_names(met_ids):
     """
     Builds a dictionary mapping KEGG compound IDs to their chemical names.
     """
+    records = fetch_records(met_ids, "Fetching compound names")
     cpd_string_dict = {}
-    for kegg_id in tqdm(met_ids, desc="Fetching compound names"):
-        try:
-            # Fetch entry from KEGG
-            record = REST.kegg_get(kegg_id).read()
-            # Parse the NAME field (first name is primary)
-            for line in record.split('\n'):
-                if line.startswith("NAME"):
-                    name = line.split("NAME")[1].strip().split(';')[0]
-                    cpd_string_dict[kegg_id] = name
-                    break
-            else:
-                cpd_string_dict[kegg_id] = "Unknown"
-        except Exception as e:
-            cpd_string_dict[kegg_id] = "Unknown"
-        time.sleep(sleep_time)  # Polite delay
+    for kegg_id, record in records.items():
+        m = NAME_RE.search(record) if record else None
+        cpd_string_dict[kegg_id] = m.group(1).strip() if m else "Unknown"
     return cpd_string_dict
 
-def get_rxn_names(rxn_ids, sleep_time=0.1):
+def get_rxn_names(rxn_ids):
     """
     Builds a dictionary mapping KEGG reaction IDs to their equation strings.
     """
-    rxn_string_dict = {}
-    base_eqn_cache = {}
-
-    for rxn_id in tqdm(rxn_ids, desc="Fetching reaction equations"):
-        # Remove _f or _r suffix for KEGG lookup
-        base_id = rxn_id[:-2] if rxn_id.endswith(('_f', '_r')) else rxn_id
-
-        # Only fetch from KEGG if not already cached
-        if base_id not in base_eqn_cache:
-            try:
-                record = REST.kegg_get(base_id).read()
-                equation = None
-                for line in record.split('\n'):
-                    if line.startswith("EQUATION"):
-                        equation = line.split("EQUATION")[1].strip()
-                        break
-                if equation is None:
-                    equation = "Unknown"
-                base_eqn_cache[base_id] = equation
-            except Exception as e:
-                base_eqn_cache[base_id] = "Unknown"
-            time.sleep(sleep_time)  # Polite delay
+    # Remove _f or _r suffix for KEGG lookup, fetching each base ID only once
+    base_ids = {rxn_id: rxn_id[:-2] if rxn_id.endswith(('_f', '_r')) else rxn_id
+                for rxn_id in rxn_ids}
+    records = fetch_records(list(dict.fromkeys(base_ids.values())),
+                            "Fetching reaction equations")
 
-        rxn_string_dict[rxn_id] = base_eqn_cache[base_id]
+    base_eqn_cache = {}
+    for base_id, record in records.items():
+        m = EQUATION_RE.search(record) if record else None
+        base_eqn_cache[base_id] = m.group(1).strip() if m else "Unknown"
 
+    rxn_string_dict = {rxn_id: base_eqn_cache[base_id] for rxn_id, base_id in base_ids.items()}
     return rxn_string_dict
 
 #-------------------------------------------------------------------------